@@ -6,10 +6,15 @@ from PIL import Image
 import pandas as pd
 import re
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timezone
 import io
+import gzip
 import numpy as np
 from users import add_user, verify_user
+from image_hash import HashIndex, dhash
+from receipt_classifier import get_classifier, save_ocr_text, record_correction
+import data_version
+from file_lock import file_lock
 import hashlib
 import csv
 import json
@@ -18,6 +23,10 @@ app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'input_images')
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.secret_key = os.urandom(24)  # Required for session management
+app.config['GZIP_MIN_SIZE'] = 1024  # Compress JSON responses larger than this many bytes
+
+# Every read-modify-write of the CSV holds this file's lock, which the ingestion daemon shares
+OUTPUT_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'output.csv')
 
 # Ensure upload and data directories exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
@@ -26,6 +35,44 @@ os.makedirs('extracted_data', exist_ok=True)
 # Set Tesseract path
 pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
+# Perceptual hashes of stored receipts, used to catch re-photographed duplicates
+hash_index = HashIndex()
+
+@app.after_request
+def compress_json(response):
+    if (response.mimetype != 'application/json'
+            or response.status_code != 200
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not request.accept_encodings['gzip']):
+        return response
+
+    data = response.get_data()
+    if len(data) < app.config['GZIP_MIN_SIZE']:
+        return response
+
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+def not_modified(version, updated_at):
+    """Check the request's validators against the current data version"""
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(f'v{version}')
+    # Last-Modified only has second resolution, so it is used only when no ETag was sent
+    if request.if_modified_since:
+        return int(updated_at) <= request.if_modified_since.timestamp()
+    return False
+
+def versioned_response(response, version, updated_at):
+    response.set_etag(f'v{version}', weak=True)
+    response.last_modified = datetime.fromtimestamp(int(updated_at), timezone.utc)
+    # Let browsers keep the payload but revalidate it on every fetch
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Data-Version'] = str(version)
+    return response
+
 # Login required decorator
 def login_required(f):
     def decorated_function(*args, **kwargs):
@@ -86,16 +133,66 @@ def landing():
 def dashboard():
     return render_template('index.html')
 
-def preprocess_image(image_path):
+def load_grayscale(image_path):
     image = cv2.imread(image_path, cv2.IMREAD_COLOR)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def decode_grayscale(data):
+    """Decode uploaded bytes the same way load_grayscale reads a file; None if not an image"""
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+def find_stored_duplicate(image_hash):
+    """Return (filename, distance) of a stored receipt that looks the same, skipping stale index entries"""
+    duplicate = hash_index.find_duplicate(image_hash)
+    while duplicate and not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], duplicate[0])):
+        # The matching image is gone, so drop the entry and look for the next candidate
+        hash_index.remove(duplicate[0])
+        duplicate = hash_index.find_duplicate(image_hash)
+    return duplicate
+
+def unique_upload_name(filename):
+    """Add a timestamp when a stored receipt already uses filename, so it is never overwritten"""
+    if not os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], filename)):
+        return filename
+    stem, ext = os.path.splitext(filename)
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    candidate = f'{stem}_{timestamp}{ext}'
+    counter = 1
+    while os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], candidate)):
+        candidate = f'{stem}_{timestamp}_{counter}{ext}'
+        counter += 1
+    return candidate
+
+def backfill_hash_index():
+    """Hash stored receipts that are missing from the index, without running OCR"""
+    added = 0
+    for filename in os.listdir(app.config['UPLOAD_FOLDER']):
+        if not filename.lower().endswith(('.png', '.jpg', '.jpeg')) or filename in hash_index:
+            continue
+        try:
+            hash_index.add(filename, dhash(load_grayscale(os.path.join(app.config['UPLOAD_FOLDER'], filename))), save=False)
+            added += 1
+        except Exception as e:
+            print(f"Error hashing {filename}: {str(e)}")
+    if added:
+        hash_index.save()
+        print(f"Added {added} existing receipts to the hash index")
+
+backfill_hash_index()
+
+def preprocess_image(image_path, gray=None):
+    if gray is None:
+        gray = load_grayscale(image_path)
     _, threshold = cv2.threshold(gray, 150, 255, cv2.THRESH_BINARY)
     return threshold
 
-def extract_text(image_path):
+def extract_text(image_path, gray=None):
     try:
         print(f"Extracting text from: {image_path}")
-        processed = preprocess_image(image_path)
+        processed = preprocess_image(image_path, gray)
         text = pytesseract.image_to_string(processed)
         return text
     except Exception as e:
@@ -113,6 +210,17 @@ def classify_type(text):
     else:
         return "Unknown"
 
+def classify_category(text):
+    text = text.lower()
+    if any(keyword in text for keyword in ["restaurant", "food", "dining", "cafe", "meal"]):
+        return "Food"
+    elif any(keyword in text for keyword in ["flight", "uber", "taxi", "bus", "travel", "trip", "train"]):
+        return "Travel"
+    elif any(keyword in text for keyword in ["movie", "theater", "concert", "netflix", "event", "entertainment"]):
+        return "Entertainment"
+    else:
+        return "Other"
+
 def extract_fields(text):
     text_lower = text.lower()
 
@@ -144,14 +252,7 @@ def extract_fields(text):
             break
 
     # Category Detection
-    if any(keyword in text_lower for keyword in ["restaurant", "food", "dining", "cafe", "meal"]):
-        category = "Food"
-    elif any(keyword in text_lower for keyword in ["flight", "uber", "taxi", "bus", "travel", "trip", "train"]):
-        category = "Travel"
-    elif any(keyword in text_lower for keyword in ["movie", "theater", "concert", "netflix", "event", "entertainment"]):
-        category = "Entertainment"
-    else:
-        category = "Other"
+    category = classify_category(text_lower)
 
     return {
         "date": date if date else "Not found",
@@ -159,13 +260,22 @@ def extract_fields(text):
         "category": category
     }
 
-def analyze_receipt(image_path):
+def analyze_receipt(image_path, gray=None):
     try:
         print(f"Processing image: {image_path}")
-        text = extract_text(image_path)
+        text = extract_text(image_path, gray)
         print(f"Extracted text: {text[:100]}...")  # Print first 100 chars of extracted text
+        save_ocr_text(os.path.basename(image_path), text)
         receipt_type = classify_type(text)
         fields = extract_fields(text)
+
+        # Prefer the model trained on user corrections; the keyword rules decide when it is unsure
+        classifier = get_classifier()
+        if classifier:
+            predicted_type, predicted_category = classifier.predict(text)
+            receipt_type = predicted_type or receipt_type
+            fields['category'] = predicted_category or fields['category']
+
         result = {
             "type": receipt_type,
             **fields
@@ -193,11 +303,31 @@ def upload_file():
                 filename = f'captured_receipt_{timestamp}.jpg'
             else:
                 filename = secure_filename(file.filename)
-                
+
+            # Check for a near-duplicate before the upload touches stored receipts or pays for OCR
+            data = file.read()
+            gray = decode_grayscale(data)
+            if gray is None:
+                return jsonify({'error': 'Uploaded file is not a readable image'}), 400
+            image_hash = dhash(gray)
+            if request.form.get('force') != 'true':
+                duplicate = find_stored_duplicate(image_hash)
+                if duplicate:
+                    duplicate_of, distance = duplicate
+                    print(f"Skipping {filename}: near-duplicate of {duplicate_of} (distance {distance})")
+                    return jsonify({
+                        'duplicate': True,
+                        'duplicate_of': duplicate_of,
+                        'distance': distance,
+                        'message': f'Receipt looks like a duplicate of {duplicate_of}'
+                    })
+
+            filename = unique_upload_name(filename)
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             
             # Save the file
-            file.save(filepath)
+            with open(filepath, 'wb') as f:
+                f.write(data)
             print(f"Saved file to: {filepath}")
             
             # Verify the image was saved correctly
@@ -205,20 +335,23 @@ def upload_file():
                 return jsonify({'error': 'Failed to save image'}), 500
                 
             # Process the image
-            result, saved_filename = analyze_receipt(filepath)
+            result, saved_filename = analyze_receipt(filepath, gray)
+            hash_index.add(saved_filename, image_hash)
             print(f"Analysis result: {result}")
             
             # Save to CSV
-            df = pd.DataFrame([{**result, 'filename': saved_filename}])
-            output_csv = os.path.join("extracted_data", "output.csv")
+            df = pd.DataFrame([{**result, 'file': saved_filename}])
+            output_csv = OUTPUT_CSV
             
             # Create directory if it doesn't exist
             os.makedirs(os.path.dirname(output_csv), exist_ok=True)
             
-            if os.path.exists(output_csv):
-                df.to_csv(output_csv, mode='a', header=False, index=False)
-            else:
-                df.to_csv(output_csv, index=False)
+            with file_lock(OUTPUT_CSV):
+                if os.path.exists(output_csv):
+                    df.to_csv(output_csv, mode='a', header=False, index=False)
+                else:
+                    df.to_csv(output_csv, index=False)
+                data_version.bump(changed=[saved_filename])
                 
             print(f"Saved data to CSV: {output_csv}")
 
@@ -228,50 +361,78 @@ def upload_file():
             print(f"Error in upload_file: {str(e)}")
             return jsonify({'error': str(e)}), 500
 
-@app.route('/get_data')
-def get_data():
-    try:
-        # Use absolute path for CSV file
-        csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'output.csv')
-        print(f"Looking for CSV file at: {csv_path}")
+def load_records():
+    # Use absolute path for CSV file
+    csv_path = OUTPUT_CSV
+    print(f"Looking for CSV file at: {csv_path}")
+    
+    if not os.path.exists(csv_path):
+        print("CSV file does not exist")
+        return []
         
-        if not os.path.exists(csv_path):
-            print("CSV file does not exist")
-            return jsonify([])
-            
-        print("Reading CSV file...")
+    print("Reading CSV file...")
+    with file_lock(OUTPUT_CSV):
         df = pd.read_csv(csv_path)
-        print(f"CSV raw contents: {df.to_dict('records')}")
+    print(f"CSV raw contents: {df.to_dict('records')}")
+    
+    if df.empty:
+        print("CSV file is empty")
+        return []
         
-        if df.empty:
-            print("CSV file is empty")
-            return jsonify([])
-            
-        # Map the columns correctly
-        records = []
-        for _, row in df.iterrows():
-            # Convert row to dict and get the first value of each column as the key
-            row_dict = row.to_dict()
-            keys = list(row_dict.keys())
-            
-            record = {
-                'type': row_dict.get(keys[0], 'Unknown'),
-                'date': row_dict.get(keys[1], 'Not found'),
-                'amount': row_dict.get(keys[2], 'Not found'),
-                'category': row_dict.get(keys[3], 'Other'),
-                'file': row_dict.get(keys[4], None)
-            }
-            
-            # Only add records that have a valid filename
-            if record['file'] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], record['file'])):
-                records.append(record)
-            else:
-                print(f"Skipping record due to missing or invalid file: {record}")
+    # Map the columns correctly
+    records = []
+    for _, row in df.iterrows():
+        # Convert row to dict and get the first value of each column as the key
+        row_dict = row.to_dict()
+        keys = list(row_dict.keys())
+        
+        record = {
+            'type': row_dict.get(keys[0], 'Unknown'),
+            'date': row_dict.get(keys[1], 'Not found'),
+            'amount': row_dict.get(keys[2], 'Not found'),
+            'category': row_dict.get(keys[3], 'Other'),
+            'file': row_dict.get(keys[4], None)
+        }
         
-        print(f"Returning {len(records)} processed records: {records}")
-        return jsonify(records)
+        # Only add records that have a valid filename
+        if record['file'] and os.path.exists(os.path.join(app.config['UPLOAD_FOLDER'], record['file'])):
+            records.append(record)
+        else:
+            print(f"Skipping record due to missing or invalid file: {record}")
+    
+    return records
+
+@app.route('/get_data')
+def get_data():
+    since = request.args.get('since')
+    try:
+        if since is not None and not since.isdigit():
+            return jsonify({'error': 'since must be a non-negative integer version'}), 400
+
+        # Answer revalidations from the change counter without touching the CSV
+        version, updated_at = data_version.current()
+        if since is not None and int(since) > version:
+            # The client saw a newer version, so the change log was reset and only a full reload is safe
+            return jsonify({'error': 'Unknown data version, reload without since'}), 410
+        if not_modified(version, updated_at):
+            return versioned_response(app.response_class(status=304), version, updated_at)
+
+        records = load_records()
+        if since is None:
+            print(f"Returning {len(records)} processed records: {records}")
+            return versioned_response(jsonify(records), version, updated_at)
+
+        # Delta query: only rows changed or deleted after the client's version
+        changed, deleted = data_version.changes_since(int(since))
+        return versioned_response(jsonify({
+            'version': version,
+            'changed': [record for record in records if record['file'] in changed],
+            'deleted': sorted(deleted)
+        }), version, updated_at)
     except Exception as e:
         print(f"Error in get_data: {str(e)}")
+        if since is not None:
+            return jsonify({'error': str(e)}), 500
         return jsonify([])
 
 @app.route('/input_images/<filename>')
@@ -281,11 +442,12 @@ def serve_image(filename):
 @app.route('/export/excel')
 def export_excel():
     try:
-        output_csv = os.path.join("extracted_data", "output.csv")
+        output_csv = OUTPUT_CSV
         if not os.path.exists(output_csv):
             return jsonify({'error': 'No data available'}), 404
             
-        df = pd.read_csv(output_csv)
+        with file_lock(OUTPUT_CSV):
+            df = pd.read_csv(output_csv)
         if df.empty:
             return jsonify({'error': 'No data available'}), 404
             
@@ -307,12 +469,17 @@ def export_excel():
 @app.route('/export/csv')
 def export_csv():
     try:
-        output_csv = os.path.join("extracted_data", "output.csv")
+        output_csv = OUTPUT_CSV
         if not os.path.exists(output_csv):
             return jsonify({'error': 'No data available'}), 404
             
+        # Snapshot the file so a concurrent rewrite cannot truncate the download
+        with file_lock(OUTPUT_CSV):
+            with open(output_csv, 'rb') as f:
+                csv_file = io.BytesIO(f.read())
+            
         return send_file(
-            output_csv,
+            csv_file,
             mimetype='text/csv',
             as_attachment=True,
             download_name='receipts.csv'
@@ -327,27 +494,31 @@ def delete_receipt(filename):
         # Secure the filename and get paths
         filename = secure_filename(filename)
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'output.csv')
+        csv_path = OUTPUT_CSV
         
         print(f"Attempting to delete receipt: {filename}")
         
         # Check if CSV exists and update it first
         if os.path.exists(csv_path):
             try:
-                df = pd.read_csv(csv_path)
-                print(f"Current records in CSV: {len(df)}")
+                with file_lock(OUTPUT_CSV):
+                    df = pd.read_csv(csv_path)
+                    print(f"Current records in CSV: {len(df)}")
                 
-                # Remove the record from DataFrame
-                df_filtered = df[df['file'] != filename]
-                print(f"Records after filtering: {len(df_filtered)}")
+                    # Remove the record from DataFrame
+                    df_filtered = df[df['file'] != filename]
+                    print(f"Records after filtering: {len(df_filtered)}")
                 
-                # Save updated DataFrame back to CSV
-                df_filtered.to_csv(csv_path, index=False)
+                    # Save updated DataFrame back to CSV
+                    df_filtered.to_csv(csv_path, index=False)
+                    data_version.bump(deleted=[filename])
                 print(f"Updated CSV saved with {len(df_filtered)} records")
             except Exception as e:
                 print(f"Error updating CSV: {str(e)}")
                 return jsonify({'error': 'Failed to update database'}), 500
         
+        hash_index.remove(filename)
+        
         # Now try to delete the file
         if os.path.exists(file_path):
             try:
@@ -381,11 +552,22 @@ def process_existing_images():
             
         # Process each image
         processed_data = []
+        duplicates = []
+        reported_pairs = set()
         for filename in image_files:
             filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             try:
+                # Index the image and report near-duplicates for merging
+                gray = load_grayscale(filepath)
+                image_hash = dhash(gray)
+                duplicate = hash_index.find_duplicate(image_hash, exclude=filename)
+                if duplicate and frozenset((filename, duplicate[0])) not in reported_pairs:
+                    reported_pairs.add(frozenset((filename, duplicate[0])))
+                    duplicates.append({'file': filename, 'duplicate_of': duplicate[0], 'distance': duplicate[1]})
+                hash_index.add(filename, image_hash, save=False)
+
                 # Process the image
-                result, saved_filename = analyze_receipt(filepath)
+                result, saved_filename = analyze_receipt(filepath, gray)
                 print(f"Analysis result for {filename}: {result}")
                 
                 # Add to processed data with correct structure
@@ -401,21 +583,26 @@ def process_existing_images():
                 print(f"Error processing {filename}: {str(e)}")
                 continue
         
+        hash_index.save()
+        
         if processed_data:
             # Create DataFrame with correct column names
             df = pd.DataFrame(processed_data)
             
             # Ensure the extracted_data directory exists
-            csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'output.csv')
+            csv_path = OUTPUT_CSV
             os.makedirs(os.path.dirname(csv_path), exist_ok=True)
             
             # Save to CSV with proper column names
-            df.to_csv(csv_path, index=False, columns=['type', 'date', 'amount', 'category', 'file'])
+            with file_lock(OUTPUT_CSV):
+                df.to_csv(csv_path, index=False, columns=['type', 'date', 'amount', 'category', 'file'])
+                data_version.replace_all(df['file'])
             print(f"Saved {len(processed_data)} records to CSV: {csv_path}")
             
             return jsonify({
                 'message': f'Processed {len(processed_data)} images successfully',
-                'data': processed_data
+                'data': processed_data,
+                'duplicates': duplicates
             })
         else:
             return jsonify({'message': 'No images were successfully processed'})
@@ -431,27 +618,35 @@ def update_receipt():
         if not data or 'filename' not in data:
             return jsonify({'error': 'Invalid request data'}), 400
 
-        csv_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'output.csv')
+        csv_path = OUTPUT_CSV
         
         if not os.path.exists(csv_path):
             return jsonify({'error': 'No receipt data found'}), 404
             
-        # Read existing data
-        df = pd.read_csv(csv_path)
+        with file_lock(OUTPUT_CSV):
+            # Read existing data
+            df = pd.read_csv(csv_path)
         
-        # Find the row with matching filename
-        mask = df['file'] == data['filename']
-        if not any(mask):
-            return jsonify({'error': 'Receipt not found'}), 404
+            # Find the row with matching filename
+            mask = df['file'] == data['filename']
+            if not any(mask):
+                return jsonify({'error': 'Receipt not found'}), 404
+            previous = df.loc[mask, ['type', 'category']].iloc[0]
+            relabelled = str(previous['type']) != str(data['type']) or str(previous['category']) != str(data['category'])
             
-        # Update the row
-        df.loc[mask, 'type'] = data['type']
-        df.loc[mask, 'date'] = data['date']
-        df.loc[mask, 'amount'] = data['amount']
-        df.loc[mask, 'category'] = data['category']
+            # Update the row
+            df.loc[mask, 'type'] = data['type']
+            df.loc[mask, 'date'] = data['date']
+            df.loc[mask, 'amount'] = data['amount']
+            df.loc[mask, 'category'] = data['category']
         
-        # Save back to CSV
-        df.to_csv(csv_path, index=False)
+            # Save back to CSV
+            df.to_csv(csv_path, index=False)
+            data_version.bump(changed=[data['filename']])
+        
+        # Keep relabelled receipts as training data; edits to date or amount say nothing about the labels
+        if relabelled:
+            record_correction(data['filename'], data['type'], data['category'])
         
         return jsonify({
             'message': 'Receipt updated successfully',
@@ -481,31 +676,34 @@ def profile():
 @login_required
 def user_stats():
     try:
+        version, updated_at = data_version.current()
+        if not_modified(version, updated_at):
+            return versioned_response(app.response_class(status=304), version, updated_at)
+
         # Read the CSV file to get statistics
-        csv_path = os.path.join(app.root_path, 'extracted_data', 'output.csv')
         total_receipts = 0
         total_expenses = 0.0
         
-        if os.path.exists(csv_path):
-            with open(csv_path, 'r') as f:
-                reader = csv.DictReader(f)
-                receipts = list(reader)
-                total_receipts = len(receipts)
+        if os.path.exists(OUTPUT_CSV):
+            with file_lock(OUTPUT_CSV):
+                with open(OUTPUT_CSV, 'r') as f:
+                    receipts = list(csv.DictReader(f))
+            total_receipts = len(receipts)
                 
-                for receipt in receipts:
-                    try:
-                        # Remove currency symbols and commas, then convert to float
-                        amount_str = receipt.get('amount', '0')
-                        amount_str = ''.join(c for c in amount_str if c.isdigit() or c in '.-')
-                        amount = float(amount_str) if amount_str else 0
-                        total_expenses += amount
-                    except (ValueError, TypeError):
-                        continue
+            for receipt in receipts:
+                try:
+                    # Remove currency symbols and commas, then convert to float
+                    amount_str = receipt.get('amount', '0')
+                    amount_str = ''.join(c for c in amount_str if c.isdigit() or c in '.-')
+                    amount = float(amount_str) if amount_str else 0
+                    total_expenses += amount
+                except (ValueError, TypeError):
+                    continue
         
-        return jsonify({
+        return versioned_response(jsonify({
             'totalReceipts': total_receipts,
             'totalExpenses': total_expenses
-        })
+        }), version, updated_at)
     except Exception as e:
         app.logger.error(f"Error getting user stats: {str(e)}")
         return jsonify({'error': 'Failed to load user statistics'}), 500
@@ -0,0 +1,73 @@
+import json
+import os
+import threading
+import time
+from file_lock import file_lock, file_key, atomic_write
+
+VERSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'data_version.json')
+
+# Guards the in-process cache; writes also hold a file lock shared with other processes
+_lock = threading.Lock()
+_state = None
+_state_key = None
+
+def _empty_state():
+    return {'version': 0, 'updated_at': time.time(), 'files': {}}
+
+def _load(force=False):
+    """Return the change log, re-reading it only when another process has written it"""
+    global _state, _state_key
+    key = file_key(VERSION_FILE)
+    if force or _state is None or key != _state_key:
+        if key is None:
+            _state = _empty_state()
+        else:
+            with open(VERSION_FILE, 'r') as f:
+                _state = json.load(f)
+        _state_key = key
+    return _state
+
+def _save(state):
+    global _state_key
+    with atomic_write(VERSION_FILE) as f:
+        json.dump(state, f, indent=4)
+    _state_key = file_key(VERSION_FILE)
+
+def _bump(changed, deleted, replace=False):
+    # The read-modify-write runs under the file lock, re-reading the file first, so
+    # concurrent writers in other processes never hand out the same version twice
+    with _lock, file_lock(VERSION_FILE):
+        state = _load(force=True)
+        if replace:
+            deleted = [f for f, entry in state['files'].items() if not entry['deleted'] and f not in changed]
+        state['version'] += 1
+        state['updated_at'] = time.time()
+        # Each file keeps only its latest change, so the log is bounded by the number of receipts
+        for filename in changed:
+            state['files'][filename] = {'version': state['version'], 'deleted': False}
+        for filename in deleted:
+            state['files'][filename] = {'version': state['version'], 'deleted': True}
+        _save(state)
+        return state['version']
+
+def current():
+    """Return (version, updated_at) of the receipt data"""
+    with _lock:
+        state = _load()
+        return state['version'], state['updated_at']
+
+def bump(changed=(), deleted=()):
+    """Record that receipts were added/edited or deleted and return the new version"""
+    return _bump(list(changed), list(deleted))
+
+def replace_all(filenames):
+    """Record a full rewrite of the data: everything not in filenames is gone"""
+    return _bump(set(filenames), [], replace=True)
+
+def changes_since(version):
+    """Return (changed, deleted) sets of filenames modified after version"""
+    with _lock:
+        files = _load()['files']
+        changed = {f for f, entry in files.items() if entry['version'] > version and not entry['deleted']}
+        deleted = {f for f, entry in files.items() if entry['version'] > version and entry['deleted']}
+    return changed, deleted
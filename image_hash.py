@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import cv2
+from file_lock import file_lock, file_key, atomic_write
+
+HASH_INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'extracted_data', 'image_hashes.json')
+
+# Two photos of the same receipt usually land within a few bits of each other,
+# while unrelated receipts sit around 32 bits apart on a 64-bit hash.
+DUPLICATE_THRESHOLD = 10
+
+def dhash(gray, hash_size=8):
+    """Compute a difference hash from an already-decoded grayscale image"""
+    # One extra column so each row yields hash_size left/right comparisons
+    resized = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    diff = resized[:, 1:] > resized[:, :-1]
+    value = 0
+    for bit in diff.flatten():
+        value = (value << 1) | int(bit)
+    return value
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class BKTree:
+    """Burkhard-Keller tree over integer hashes using Hamming distance"""
+
+    def __init__(self):
+        self.root = None
+
+    def add(self, value, key):
+        if self.root is None:
+            self.root = [value, key, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, key, {}]
+                return
+            node = child
+
+    def search(self, value, max_distance):
+        """Return (distance, key) pairs within max_distance, closest first"""
+        matches = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= max_distance:
+                matches.append((distance, node[1]))
+            # Triangle inequality: only children in this band can match
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return sorted(matches)
+
+class HashIndex:
+    """Persistent filename -> perceptual hash map with a BK-tree for lookups
+
+    The app and the ingestion daemon share the JSON file, so every write
+    re-reads it under a file lock and every lookup picks up the other
+    process's changes.
+    """
+
+    def __init__(self, path=HASH_INDEX_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes = {}
+        self.tree = BKTree()
+        # Changes not yet written: filename -> hash, or None for a removal
+        self.dirty = {}
+        self.file_key = None
+        self._refresh()
+
+    def _refresh(self):
+        """Reload the file if another process changed it, keeping unsaved changes"""
+        current_key = file_key(self.path)
+        if current_key == self.file_key:
+            return
+        stored = {}
+        if current_key is not None:
+            try:
+                with open(self.path, 'r') as f:
+                    stored = json.load(f)
+            except (ValueError, OSError) as e:
+                print(f"Error loading hash index: {str(e)}")
+                return
+        self.hashes = {filename: int(value, 16) for filename, value in stored.items()}
+        for filename, value in self.dirty.items():
+            if value is None:
+                self.hashes.pop(filename, None)
+            else:
+                self.hashes[filename] = value
+        self.file_key = current_key
+        self._rebuild()
+
+    def _rebuild(self):
+        self.tree = BKTree()
+        for filename, value in self.hashes.items():
+            self.tree.add(value, filename)
+
+    def _save(self):
+        if not self.dirty:
+            return
+        with file_lock(self.path):
+            self._refresh()
+            with atomic_write(self.path) as f:
+                json.dump({filename: format(value, '016x') for filename, value in self.hashes.items()}, f, indent=4)
+            self.dirty = {}
+            self.file_key = file_key(self.path)
+
+    def __contains__(self, filename):
+        with self.lock:
+            self._refresh()
+            return filename in self.hashes
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def find_duplicate(self, value, exclude=None, max_distance=DUPLICATE_THRESHOLD):
+        """Return (filename, distance) of the closest indexed image, or None"""
+        with self.lock:
+            self._refresh()
+            for distance, filename in self.tree.search(value, max_distance):
+                if filename != exclude:
+                    return filename, distance
+        return None
+
+    def add(self, filename, value, save=True):
+        """Index an image; pass save=False when adding many and call save() once afterwards"""
+        with self.lock:
+            self._refresh()
+            previous = self.hashes.get(filename)
+            self.hashes[filename] = value
+            self.dirty[filename] = value
+            if previous is None:
+                self.tree.add(value, filename)
+            elif previous != value:
+                # BK-trees do not support in-place updates
+                self._rebuild()
+            if save:
+                self._save()
+
+    def remove(self, filename):
+        with self.lock:
+            self._refresh()
+            if self.hashes.pop(filename, None) is not None:
+                self.dirty[filename] = None
+                self._rebuild()
+                self._save()
@@ -0,0 +1,278 @@
+import argparse
+import hashlib
+import json
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+import pandas as pd
+from werkzeug.utils import secure_filename
+from app import app, analyze_receipt, load_grayscale, find_stored_duplicate, hash_index, OUTPUT_CSV
+from image_hash import dhash, hamming, DUPLICATE_THRESHOLD
+from file_lock import file_lock, atomic_write
+import data_version
+
+try:
+    # watchdog uses inotify on Linux; without it we fall back to polling
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_FILE = os.path.join(BASE_DIR, 'extracted_data', 'ingest_manifest.json')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+COLUMNS = ['type', 'date', 'amount', 'category', 'file']
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class Manifest:
+    """Remembers path/mtime/hash of every ingested file so rescans are incremental"""
+
+    def __init__(self, path=MANIFEST_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+
+    def is_current(self, path, mtime):
+        entry = self.entries.get(path)
+        return entry is not None and entry['mtime'] == mtime
+
+    def get(self, path):
+        return self.entries.get(path)
+
+    def record(self, path, mtime, sha256, status, stored_as=None):
+        with self.lock:
+            self.entries[path] = {'mtime': mtime, 'sha256': sha256, 'status': status, 'stored_as': stored_as}
+            with atomic_write(self.path) as f:
+                json.dump(self.entries, f, indent=4)
+
+class _WakeHandler(FileSystemEventHandler):
+    def __init__(self, wake):
+        self.wake = wake
+
+    def on_any_event(self, event):
+        self.wake.set()
+
+class IngestDaemon:
+    """Feeds new or changed images from a drop folder through a pool of OCR workers"""
+
+    def __init__(self, watch_folder, workers=2, queue_size=None, interval=5.0, settle=1.0):
+        self.watch_folder = os.path.abspath(watch_folder)
+        self.upload_folder = app.config['UPLOAD_FOLDER']
+        # Files in the upload folder already went through /upload
+        if os.path.samefile(self.watch_folder, self.upload_folder):
+            raise ValueError('The watch folder must not be the upload folder')
+        self.interval = interval
+        self.settle = settle
+        self.manifest = Manifest()
+        # Bounded so a large drop blocks the scanner instead of piling up in memory
+        self.jobs = queue.Queue(maxsize=queue_size or workers * 2)
+        self.results = queue.Queue()
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        # Hashes of files being processed, keyed by drop path; they reach the hash
+        # index only once their row is saved, so a failed file is never a 'duplicate'
+        self.in_flight = {}
+        self.claim_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        self.threads.append(threading.Thread(target=self._writer, daemon=True))
+
+    def scan(self):
+        """Queue every file that is new or changed since it was last ingested"""
+        queued = 0
+        now = time.time()
+        for name in sorted(os.listdir(self.watch_folder)):
+            path = os.path.join(self.watch_folder, name)
+            if not name.lower().endswith(IMAGE_EXTENSIONS) or not os.path.isfile(path):
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                continue
+            # Leave files alone until the scanner or mail client has finished writing them
+            if now - mtime < self.settle or self.manifest.is_current(path, mtime):
+                continue
+            with self.pending_lock:
+                if path in self.pending:
+                    continue
+                self.pending.add(path)
+            self.jobs.put((path, mtime))
+            queued += 1
+        return queued
+
+    def _worker(self):
+        while True:
+            path, mtime = self.jobs.get()
+            try:
+                self.results.put(self._process(path, mtime))
+            except Exception as e:
+                print(f"Error ingesting {path}: {str(e)}")
+                self.results.put((path, mtime, None, 'error', None, None, None))
+            finally:
+                self.jobs.task_done()
+
+    def _stored_name(self, path):
+        """Unique name in the upload folder, so scanners reusing names like scan0001.jpg never clobber a receipt"""
+        stem, ext = os.path.splitext(secure_filename(os.path.basename(path)) or 'receipt.jpg')
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        return f'ingested_{timestamp}_{uuid.uuid4().hex[:8]}_{stem}{ext.lower()}'
+
+    def _claim(self, path, image_hash):
+        """Return a stored or in-flight near-duplicate of image_hash, or reserve it for path"""
+        # One lock around check and reserve, so two workers never both accept copies of one receipt
+        with self.claim_lock:
+            duplicate = find_stored_duplicate(image_hash)
+            if duplicate:
+                return duplicate
+            for other, value in self.in_flight.items():
+                distance = hamming(image_hash, value)
+                if distance <= DUPLICATE_THRESHOLD:
+                    return other, distance
+            self.in_flight[path] = image_hash
+            return None
+
+    def _release(self, path):
+        with self.claim_lock:
+            self.in_flight.pop(path, None)
+
+    def _process(self, path, mtime):
+        sha256 = file_sha256(path)
+        entry = self.manifest.get(path)
+        if entry and entry['sha256'] == sha256:
+            # Touched but not modified
+            return path, mtime, sha256, entry['status'], entry.get('stored_as'), None, None
+
+        # Check for a duplicate before anything lands in the upload folder
+        gray = load_grayscale(path)
+        image_hash = dhash(gray)
+        duplicate = self._claim(path, image_hash)
+        if duplicate:
+            print(f"Skipping {path}: near-duplicate of {duplicate[0]} (distance {duplicate[1]})")
+            return path, mtime, sha256, 'duplicate', None, None, None
+
+        filename = self._stored_name(path)
+        target = os.path.join(self.upload_folder, filename)
+        shutil.copy2(path, target)
+        try:
+            result, saved_filename = analyze_receipt(target, gray)
+        except Exception:
+            os.remove(target)
+            raise
+        return path, mtime, sha256, 'processed', saved_filename, {**result, 'file': saved_filename}, image_hash
+
+    def _writer(self):
+        """Single writer thread; the file lock also serialises it against the web app"""
+        while True:
+            path, mtime, sha256, status, stored_as, record, image_hash = self.results.get()
+            try:
+                if record is not None:
+                    try:
+                        self._append(record)
+                    except Exception as e:
+                        # Without its row the copy is an orphan, and indexing it would reject the file as a duplicate
+                        print(f"Error saving {path}: {str(e)}")
+                        os.remove(os.path.join(self.upload_folder, stored_as))
+                        status, stored_as = 'error', None
+                    else:
+                        hash_index.add(stored_as, image_hash)
+                # Failed files are recorded too, so they are retried only once they change
+                self.manifest.record(path, mtime, sha256, status, stored_as)
+                print(f"Ingested {path}: {status}")
+            except Exception as e:
+                print(f"Error saving {path}: {str(e)}")
+            finally:
+                self._release(path)
+                with self.pending_lock:
+                    self.pending.discard(path)
+                self.results.task_done()
+
+    def _append(self, record):
+        """Append a row; stored names are unique, so it can never overwrite an edit made in the app"""
+        df = pd.DataFrame([record], columns=COLUMNS)
+        os.makedirs(os.path.dirname(OUTPUT_CSV), exist_ok=True)
+        with file_lock(OUTPUT_CSV):
+            if os.path.exists(OUTPUT_CSV):
+                df.to_csv(OUTPUT_CSV, mode='a', header=False, index=False)
+            else:
+                df.to_csv(OUTPUT_CSV, index=False)
+            data_version.bump(changed=[record['file']])
+
+    def stop(self):
+        self.stopping.set()
+        self.wake.set()
+
+    def drain(self):
+        self.jobs.join()
+        self.results.join()
+
+    def run(self, once=False):
+        for thread in self.threads:
+            thread.start()
+
+        observer = None
+        if not once and Observer is not None:
+            observer = Observer()
+            observer.schedule(_WakeHandler(self.wake), self.watch_folder, recursive=False)
+            observer.start()
+            print(f"Watching {self.watch_folder} for changes")
+        elif not once:
+            print(f"watchdog not installed, polling {self.watch_folder} every {self.interval}s")
+
+        try:
+            while not self.stopping.is_set():
+                queued = self.scan()
+                if queued:
+                    print(f"Queued {queued} file(s) for ingestion")
+                if once:
+                    # Files still settling are picked up on the next pass
+                    self.drain()
+                    break
+                # Events only wake the loop early; the periodic rescan catches anything missed
+                self.wake.wait(self.interval)
+                self.wake.clear()
+        except KeyboardInterrupt:
+            print("Stopping ingestion daemon")
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            self.drain()
+
+def main():
+    parser = argparse.ArgumentParser(description='Continuously ingest receipt images from a drop folder')
+    parser.add_argument('--watch-folder', required=True, help='Folder to watch for new receipts')
+    parser.add_argument('--workers', type=int, default=2, help='Number of OCR worker threads')
+    parser.add_argument('--queue-size', type=int, default=None, help='Maximum queued files before scanning blocks')
+    parser.add_argument('--interval', type=float, default=5.0, help='Seconds between rescans')
+    parser.add_argument('--settle', type=float, default=1.0, help='Seconds a file must be unmodified before ingestion')
+    parser.add_argument('--once', action='store_true', help='Process pending files and exit')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.watch_folder):
+        print(f"Error: Folder not found - {args.watch_folder}")
+        return
+
+    try:
+        daemon = IngestDaemon(args.watch_folder, args.workers, args.queue_size, args.interval, args.settle)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return
+    daemon.run(once=args.once)
+
+if __name__ == "__main__":
+    main()
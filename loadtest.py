@@ -0,0 +1,404 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import cv2
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MIX = 'upload=2,get_data=6,update_receipt=2,delete=1,export_csv=1,export_excel=1'
+
+# Run inside the sandboxed copy of the app: replace Tesseract with a stub that
+# sleeps for the configured latency and returns a plausible receipt.
+STUB_SERVER = """
+import os, random, time
+import pytesseract
+
+latency = float(os.environ['OCR_STUB_LATENCY'])
+jitter = float(os.environ['OCR_STUB_JITTER'])
+
+def image_to_string(image, *args, **kwargs):
+    time.sleep(max(0.0, random.gauss(latency, jitter)))
+    return f"Receipt\\nCafe meal\\nTotal: ${random.randint(1, 500)}.{random.randint(0, 99):02d}"
+
+pytesseract.image_to_string = image_to_string
+
+import app
+app.app.run(host='127.0.0.1', port=int(os.environ['LOADTEST_PORT']), threaded=True)
+"""
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight or 1)
+    unknown = set(weights) - set(LoadTest.OPERATIONS)
+    if unknown:
+        raise ValueError(f"Unknown operations in mix: {', '.join(sorted(unknown))}")
+    return weights
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(np.ceil(pct / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+def normalize_amount(amount):
+    # The CSV round trip turns '12.50' into 12.5
+    try:
+        return float(str(amount).replace(',', ''))
+    except ValueError:
+        return str(amount)
+
+def random_receipt_image():
+    # Noise gives every upload a distinct perceptual hash, so uploads are not
+    # mistaken for duplicates of each other
+    pixels = np.random.randint(0, 256, (64, 64), dtype=np.uint8)
+    return cv2.imencode('.png', pixels)[1].tobytes()
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class SandboxServer:
+    """Copy of the app in a temporary directory, served with a stubbed Tesseract"""
+
+    def __init__(self, ocr_latency, ocr_jitter):
+        self.ocr_latency = ocr_latency
+        self.ocr_jitter = ocr_jitter
+        self.workdir = None
+        self.process = None
+        self.url = None
+
+    def __enter__(self):
+        self.workdir = tempfile.mkdtemp(prefix='expense_loadtest_')
+        for name in os.listdir(BASE_DIR):
+            if name.endswith('.py'):
+                shutil.copy2(os.path.join(BASE_DIR, name), self.workdir)
+        shutil.copytree(os.path.join(BASE_DIR, 'templates'), os.path.join(self.workdir, 'templates'))
+
+        port = free_port()
+        env = dict(os.environ, LOADTEST_PORT=str(port),
+                   OCR_STUB_LATENCY=str(self.ocr_latency), OCR_STUB_JITTER=str(self.ocr_jitter))
+        self.process = subprocess.Popen(
+            [sys.executable, '-c', STUB_SERVER], cwd=self.workdir, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.url = f'http://127.0.0.1:{port}'
+        self._wait_until_ready()
+        return self
+
+    def _wait_until_ready(self, timeout=30):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError('Sandbox server exited during startup')
+            try:
+                urllib.request.urlopen(self.url + '/get_data', timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError('Sandbox server did not start in time')
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait(timeout=10)
+        if self.workdir is not None:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+class LoadTest:
+    OPERATIONS = ('upload', 'get_data', 'update_receipt', 'delete', 'export_csv', 'export_excel')
+
+    def __init__(self, url, concurrency, mix, duration=None, requests=None, timeout=30):
+        self.url = url.rstrip('/')
+        self.concurrency = concurrency
+        self.mix = mix
+        self.duration = duration
+        self.requests = requests
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.samples = {op: [] for op in self.OPERATIONS}
+        self.errors = {op: 0 for op in self.OPERATIONS}
+        self.issued = 0
+        # Bookkeeping of acknowledged writes, used to detect lost updates afterwards
+        self.live_files = set()
+        self.busy_files = set()
+        self.deleted_files = set()
+        self.expected_amounts = {}
+        self.labels = {}
+        self.duplicates = 0
+
+    def _request(self, method, path, body=None, headers=None):
+        req = urllib.request.Request(self.url + path, data=body, method=method, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                return response.status, response.read(), response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, e.read(), e.headers
+
+    def _take_request_slot(self):
+        with self.lock:
+            if self.requests is not None and self.issued >= self.requests:
+                return False
+            self.issued += 1
+            return True
+
+    def _claim_file(self):
+        """Reserve a receipt so writes to the same row never overlap on the client side"""
+        with self.lock:
+            available = sorted(self.live_files - self.busy_files)
+            if not available:
+                return None
+            filename = random.choice(available)
+            self.busy_files.add(filename)
+            return filename
+
+    def _release_file(self, filename):
+        with self.lock:
+            self.busy_files.discard(filename)
+
+    def op_upload(self, client):
+        filename = f'loadtest_{uuid.uuid4().hex}.png'
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+            f'Content-Type: image/png\r\n\r\n'
+        ).encode() + random_receipt_image() + f'\r\n--{boundary}--\r\n'.encode()
+        status, data, _ = self._request('POST', '/upload', body, {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+        if status == 200:
+            result = json.loads(data)
+            with self.lock:
+                if result.get('duplicate'):
+                    self.duplicates += 1
+                else:
+                    self.live_files.add(result['file'])
+                    self.expected_amounts[result['file']] = normalize_amount(result['amount'])
+                    self.labels[result['file']] = (result['type'], result['category'])
+        return 'upload', status
+
+    def op_get_data(self, client):
+        # Revalidate like the dashboard does once it has seen an ETag
+        headers = {'If-None-Match': client['etag']} if client.get('etag') else {}
+        status, _, response_headers = self._request('GET', '/get_data', headers=headers)
+        if status == 200:
+            client['etag'] = response_headers.get('ETag')
+        return 'get_data', status
+
+    def op_update_receipt(self, client):
+        filename = self._claim_file()
+        if filename is None:
+            # Nothing to edit yet; the sample is recorded as the upload it really was
+            return self.op_upload(client)
+        try:
+            amount = f'{random.randint(1, 999)}.{random.randint(0, 99):02d}'
+            # Keep the labels so the edit is not recorded as classifier training data
+            receipt_type, category = self.labels[filename]
+            body = json.dumps({'filename': filename, 'type': receipt_type, 'date': '01/01/2025',
+                               'amount': amount, 'category': category}).encode()
+            status, _, _ = self._request('POST', '/update_receipt', body, {'Content-Type': 'application/json'})
+            if status == 200:
+                with self.lock:
+                    self.expected_amounts[filename] = normalize_amount(amount)
+            return 'update_receipt', status
+        finally:
+            self._release_file(filename)
+
+    def op_delete(self, client):
+        filename = self._claim_file()
+        if filename is None:
+            return self.op_upload(client)
+        try:
+            status, _, _ = self._request('DELETE', f'/delete/{filename}')
+            if status == 200:
+                with self.lock:
+                    self.live_files.discard(filename)
+                    self.deleted_files.add(filename)
+            return 'delete', status
+        finally:
+            self._release_file(filename)
+
+    def op_export_csv(self, client):
+        return 'export_csv', self._request('GET', '/export/csv')[0]
+
+    def op_export_excel(self, client):
+        return 'export_excel', self._request('GET', '/export/excel')[0]
+
+    def _worker(self, deadline):
+        client = {}
+        operations = list(self.mix)
+        weights = [self.mix[op] for op in operations]
+        while (deadline is None or time.time() < deadline) and self._take_request_slot():
+            op = random.choices(operations, weights)[0]
+            start = time.perf_counter()
+            try:
+                # Update and delete fall back to an upload when no receipt is free,
+                # so each op reports which operation actually ran
+                op, status = getattr(self, f'op_{op}')(client)
+                failed = status >= 400 and not (op.startswith('export') and status == 404)
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.samples[op].append(elapsed)
+                if failed:
+                    self.errors[op] += 1
+
+    def run(self):
+        deadline = time.time() + self.duration if self.duration else None
+        threads = [threading.Thread(target=self._worker, args=(deadline,)) for _ in range(self.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start
+        return self.report()
+
+    def check_integrity(self):
+        """Compare the stored receipts with every write the server acknowledged"""
+        status, data, _ = self._request('GET', '/get_data')
+        if status != 200:
+            return {'error': f'/get_data returned {status}'}
+        records = json.loads(data)
+        counts = {}
+        amounts = {}
+        for record in records:
+            counts[record['file']] = counts.get(record['file'], 0) + 1
+            amounts[record['file']] = normalize_amount(record['amount'])
+        return {
+            'lost_receipts': sorted(f for f in self.live_files if f not in counts),
+            'resurrected_receipts': sorted(f for f in self.deleted_files if f in counts),
+            'duplicated_rows': sorted(f for f, count in counts.items() if count > 1),
+            # Writes to one receipt are serialised, so it must hold the last acknowledged value
+            'lost_updates': sorted(f for f in self.live_files
+                                   if f in amounts and amounts[f] != self.expected_amounts.get(f)),
+            'duplicate_uploads': self.duplicates
+        }
+
+    def cleanup(self):
+        """Delete the receipts this run uploaded and return those that could not be removed"""
+        failed = []
+        for filename in sorted(self.live_files):
+            try:
+                status = self._request('DELETE', f'/delete/{filename}')[0]
+            except Exception:
+                status = None
+            if status != 200:
+                failed.append(filename)
+        return failed
+
+    def report(self):
+        operations = {}
+        total = 0
+        total_errors = 0
+        for op in self.OPERATIONS:
+            samples = sorted(self.samples[op])
+            if not samples:
+                continue
+            total += len(samples)
+            total_errors += self.errors[op]
+            operations[op] = {
+                'requests': len(samples),
+                'throughput': len(samples) / self.elapsed,
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p95_ms': percentile(samples, 95) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'error_rate': self.errors[op] / len(samples)
+            }
+        return {
+            'concurrency': self.concurrency,
+            'elapsed_s': self.elapsed,
+            'requests': total,
+            'throughput': total / self.elapsed if self.elapsed else 0.0,
+            'error_rate': total_errors / total if total else 0.0,
+            'operations': operations,
+            'integrity': self.check_integrity()
+        }
+
+def print_report(report):
+    print(f"\n{report['requests']} requests in {report['elapsed_s']:.1f}s with {report['concurrency']} workers "
+          f"({report['throughput']:.1f} req/s, {report['error_rate']:.1%} errors)")
+    print("-" * 78)
+    print(f"{'operation':<16}{'requests':>9}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>10}")
+    for op, stats in report['operations'].items():
+        print(f"{op:<16}{stats['requests']:>9}{stats['throughput']:>9.1f}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}{stats['error_rate']:>10.1%}")
+    print("-" * 78)
+
+    integrity = report['integrity']
+    if 'error' in integrity:
+        print(f"Integrity check failed: {integrity['error']}")
+        return
+    for key in ('lost_receipts', 'resurrected_receipts', 'duplicated_rows', 'lost_updates'):
+        files = integrity[key]
+        print(f"{key.replace('_', ' ').capitalize()}: {len(files)}")
+        for filename in files[:10]:
+            print(f"  {filename}")
+    print(f"Uploads flagged as duplicates: {integrity['duplicate_uploads']}")
+    if report.get('cleanup_failed'):
+        print(f"Could not delete {len(report['cleanup_failed'])} test receipts, remove them by hand:")
+        for filename in report['cleanup_failed']:
+            print(f"  {filename}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the receipt endpoints')
+    parser.add_argument('--url', help='Target an already running instance instead of a sandboxed copy; '
+                                      'this writes to its real data, see --allow-writes')
+    parser.add_argument('--allow-writes', action='store_true',
+                        help='Confirm that --url may upload, edit and delete receipts; uploads still present '
+                             'at the end are deleted again')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run for')
+    parser.add_argument('--requests', type=int, default=None, help='Stop after this many requests instead')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'Weighted operation mix (default: {DEFAULT_MIX})')
+    parser.add_argument('--ocr-latency', type=float, default=0.5, help='Mean seconds the stubbed Tesseract takes')
+    parser.add_argument('--ocr-jitter', type=float, default=0.1, help='Standard deviation of the stubbed latency')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        print(f"Error: {str(e)}")
+        return
+    if args.requests is not None and args.requests <= 0:
+        print("Error: --requests must be positive")
+        return
+    if args.requests is None and args.duration <= 0:
+        print("Error: --duration must be positive")
+        return
+    duration = None if args.requests else args.duration
+
+    if args.url:
+        if not args.allow_writes:
+            print("Error: --url writes receipts to that instance's data; pass --allow-writes to confirm")
+            return
+        # The real Tesseract and data directory of that instance are used
+        load_test = LoadTest(args.url, args.concurrency, mix, duration, args.requests)
+        report = load_test.run()
+        report['cleanup_failed'] = load_test.cleanup()
+    else:
+        with SandboxServer(args.ocr_latency, args.ocr_jitter) as server:
+            report = LoadTest(server.url, args.concurrency, mix, duration, args.requests).run()
+
+    if args.json:
+        print(json.dumps(report, indent=4))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
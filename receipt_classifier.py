@@ -0,0 +1,260 @@
+import json
+import os
+import re
+import sys
+import threading
+import zlib
+import numpy as np
+import pandas as pd
+import data_version
+from file_lock import file_lock, file_key, atomic_write
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODEL_FILE = os.path.join(BASE_DIR, 'extracted_data', 'receipt_classifier.npz')
+TRAINING_FILE = os.path.join(BASE_DIR, 'extracted_data', 'training.jsonl')
+OCR_TEXT_DIR = os.path.join(BASE_DIR, 'extracted_data', 'ocr_text')
+
+N_FEATURES = 2 ** 18
+# Below this probability the prediction is discarded and the keyword rules decide
+MIN_CONFIDENCE = 0.6
+# Labels with fewer corrections than this are left to the keyword rules
+MIN_EXAMPLES_PER_LABEL = 3
+
+def featurize(text, n_features=N_FEATURES):
+    """Hash word unigrams and bigrams into a sparse, L2-normalised vector"""
+    tokens = re.findall(r'[a-z0-9]+', text.lower())
+    grams = tokens + [f'{a} {b}' for a, b in zip(tokens, tokens[1:])]
+    counts = {}
+    for gram in grams:
+        # crc32 rather than hash() so indices are stable across processes
+        index = zlib.crc32(gram.encode()) % n_features
+        counts[index] = counts.get(index, 0) + 1
+    indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    values = np.log1p(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+    norm = np.linalg.norm(values)
+    if norm > 0:
+        values /= norm
+    return indices, values
+
+class LinearHead:
+    """Multinomial logistic regression over hashed features"""
+
+    def __init__(self, labels, weights=None, bias=None):
+        self.labels = list(labels)
+        self.weights = weights if weights is not None else np.zeros((len(self.labels), N_FEATURES), dtype=np.float32)
+        self.bias = bias if bias is not None else np.zeros(len(self.labels), dtype=np.float32)
+
+    def fit(self, features, targets, epochs=20, learning_rate=0.5, l2=1e-4):
+        rng = np.random.default_rng(0)
+        label_index = {label: i for i, label in enumerate(self.labels)}
+        y = [label_index[target] for target in targets]
+        order = np.arange(len(features))
+        for _ in range(epochs):
+            rng.shuffle(order)
+            for i in order:
+                indices, values = features[i]
+                scores = self.weights[:, indices] @ values + self.bias
+                probs = np.exp(scores - scores.max())
+                probs /= probs.sum()
+                probs[y[i]] -= 1.0
+                self.weights[:, indices] -= learning_rate * (np.outer(probs, values) + l2 * self.weights[:, indices])
+                self.bias -= learning_rate * probs
+        return self
+
+    def predict(self, features):
+        """Return (label, probability) of the most likely label"""
+        indices, values = features
+        scores = self.weights[:, indices] @ values + self.bias
+        probs = np.exp(scores - scores.max())
+        probs /= probs.sum()
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+    def predict_batch(self, features):
+        if not features:
+            return []
+        rows = np.concatenate([np.full(len(indices), row) for row, (indices, _) in enumerate(features)])
+        indices = np.concatenate([indices for indices, _ in features])
+        values = np.concatenate([values for _, values in features])
+        scores = np.tile(self.bias, (len(features), 1))
+        np.add.at(scores, rows, (self.weights[:, indices] * values).T)
+        probs = np.exp(scores - scores.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        best = np.argmax(probs, axis=1)
+        return [(self.labels[i], float(probs[row, i])) for row, i in enumerate(best)]
+
+def _confident(prediction, min_confidence):
+    label, probability = prediction
+    return label if probability >= min_confidence else None
+
+class ReceiptClassifier:
+    """Predicts receipt type and category; a head is None until two labels have enough examples"""
+
+    def __init__(self, type_head=None, category_head=None):
+        self.type_head = type_head
+        self.category_head = category_head
+
+    @classmethod
+    def train(cls, texts, types, categories):
+        features = [featurize(text) for text in texts]
+        heads = []
+        for targets in (types, categories):
+            counts = {label: targets.count(label) for label in set(targets)}
+            labels = sorted(label for label, count in counts.items() if count >= MIN_EXAMPLES_PER_LABEL)
+            if len(labels) < 2:
+                heads.append(None)
+                continue
+            # A head can only ever predict labels it was trained on, so rare labels are left out entirely
+            kept = [i for i, target in enumerate(targets) if target in labels]
+            heads.append(LinearHead(labels).fit([features[i] for i in kept], [targets[i] for i in kept]))
+        return cls(*heads)
+
+    def predict(self, text, min_confidence=MIN_CONFIDENCE):
+        """Return (type, category); either is None when that head is untrained or unsure"""
+        features = featurize(text)
+        return (
+            _confident(self.type_head.predict(features), min_confidence) if self.type_head else None,
+            _confident(self.category_head.predict(features), min_confidence) if self.category_head else None
+        )
+
+    def predict_batch(self, texts, min_confidence=MIN_CONFIDENCE):
+        features = [featurize(text) for text in texts]
+        predictions = []
+        for head in (self.type_head, self.category_head):
+            if head is None:
+                predictions.append([None] * len(texts))
+            else:
+                predictions.append([_confident(p, min_confidence) for p in head.predict_batch(features)])
+        return list(zip(*predictions))
+
+    def save(self, path=MODEL_FILE):
+        arrays = {}
+        for name, head in (('type', self.type_head), ('category', self.category_head)):
+            if head is not None:
+                arrays[f'{name}_labels'] = np.array(head.labels)
+                arrays[f'{name}_weights'] = head.weights
+                arrays[f'{name}_bias'] = head.bias
+        # np.savez appends .npz to names without it, so write through a file handle
+        with atomic_write(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+
+    @classmethod
+    def load(cls, path=MODEL_FILE):
+        with np.load(path) as data:
+            heads = []
+            for name in ('type', 'category'):
+                if f'{name}_labels' in data:
+                    heads.append(LinearHead(data[f'{name}_labels'].tolist(), data[f'{name}_weights'], data[f'{name}_bias']))
+                else:
+                    heads.append(None)
+        return cls(*heads)
+
+_classifier = None
+_classifier_key = None
+_classifier_lock = threading.Lock()
+
+def get_classifier():
+    """Return the trained model for this process, reloading only when the file changes"""
+    global _classifier, _classifier_key
+    key = file_key(MODEL_FILE)
+    if key is None:
+        return None
+    with _classifier_lock:
+        if key != _classifier_key:
+            try:
+                _classifier = ReceiptClassifier.load(MODEL_FILE)
+            except Exception as e:
+                print(f"Error loading classifier: {str(e)}")
+                _classifier = None
+            _classifier_key = key
+        return _classifier
+
+def save_ocr_text(filename, text):
+    """Keep the OCR output so later corrections can be turned into training data"""
+    os.makedirs(OCR_TEXT_DIR, exist_ok=True)
+    with open(os.path.join(OCR_TEXT_DIR, os.path.basename(filename) + '.txt'), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+def load_ocr_text(filename):
+    path = os.path.join(OCR_TEXT_DIR, os.path.basename(filename) + '.txt')
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def record_correction(filename, receipt_type, category):
+    """Append a user-corrected label to the training set; returns False without OCR text"""
+    text = load_ocr_text(filename)
+    if text is None:
+        return False
+    os.makedirs(os.path.dirname(TRAINING_FILE), exist_ok=True)
+    with open(TRAINING_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({'file': filename, 'text': text, 'type': receipt_type, 'category': category}) + '\n')
+    return True
+
+def load_corrections():
+    """Return the latest correction per file"""
+    corrections = {}
+    if os.path.exists(TRAINING_FILE):
+        with open(TRAINING_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    example = json.loads(line)
+                    corrections[example['file']] = example
+    return corrections
+
+def train_from_corrections():
+    examples = list(load_corrections().values())
+    if not examples:
+        return None
+    model = ReceiptClassifier.train(
+        [example['text'] for example in examples],
+        [example['type'] for example in examples],
+        [example['category'] for example in examples]
+    )
+    if model.type_head is None and model.category_head is None:
+        return None
+    model.save()
+    return model
+
+def reclassify(csv_path):
+    """Re-predict type and category for every stored receipt that has not been corrected by hand"""
+    model = get_classifier()
+    if model is None:
+        return 0
+    corrected = load_corrections()
+    with file_lock(csv_path):
+        df = pd.read_csv(csv_path)
+        rows, texts = [], []
+        for i, filename in df['file'].items():
+            text = load_ocr_text(str(filename))
+            if filename not in corrected and text is not None:
+                rows.append(i)
+                texts.append(text)
+        for i, (receipt_type, category) in zip(rows, model.predict_batch(texts)):
+            if receipt_type is not None:
+                df.at[i, 'type'] = receipt_type
+            if category is not None:
+                df.at[i, 'category'] = category
+        df.to_csv(csv_path, index=False)
+        data_version.bump(changed=[df.at[i, 'file'] for i in rows])
+    return len(rows)
+
+def main():
+    if len(sys.argv) != 2 or sys.argv[1] not in ('train', 'reclassify'):
+        print("Usage: python receipt_classifier.py train|reclassify")
+        return
+
+    if sys.argv[1] == 'train':
+        model = train_from_corrections()
+        if model is None:
+            print(f"Not enough corrected receipts yet: each label needs {MIN_EXAMPLES_PER_LABEL} examples and each head two labels")
+        else:
+            print(f"Saved classifier to {MODEL_FILE}")
+    else:
+        csv_path = os.path.join(BASE_DIR, 'extracted_data', 'output.csv')
+        count = reclassify(csv_path)
+        print(f"Reclassified {count} receipts")
+
+if __name__ == "__main__":
+    main()